@@ -1,15 +1,60 @@
 import os
 import sys
+import logging
 import importlib.util
+import py_compile
 import shutil
 import tempfile
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from itertools import batched
+from types import ModuleType
 from pymongo import MongoClient
+from pymongo.errors import OperationFailure
 from dotenv import load_dotenv
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 MONGODB_URI = os.getenv("MONGODB_URI")
 DB_NAME = "test"  # Default for now, ideally from env
+VERSION_FILE = "version.txt"
+ENTRY_SCRIPT_FILE = "entry_script.txt"
+# Agent builds live under <cache>/.versions/<agent_id>/; <cache>/<agent_id> is a
+# symlink to the current one
+VERSIONS_DIR = ".versions"
+# Seconds a superseded build is left on disk before it may be removed
+VERSION_DIR_GRACE = 60
+# Files streamed per round-trip for agents stored in the agent_files collection
+AGENT_FILES_BATCH_SIZE = 16
+# Upper bound on threads used to write an agent's files to disk
+FILE_WRITE_WORKERS = 8
+# Compound index that covers the version probe, so it never reads the document
+AGENT_META_INDEX = "agent_id_1_version_1_entry_script_1"
+# Seconds to wait before retrying index creation after it failed
+INDEX_RETRY_INTERVAL = 60
+# Seconds a cached agent module is trusted before its version is re-checked
+AGENT_CACHE_TTL = float(os.getenv("AGENT_CACHE_TTL", "60"))
+# Invalidate cached modules from a MongoDB change stream (needs a replica set)
+AGENT_CACHE_WATCH = os.getenv("AGENT_CACHE_WATCH", "").lower() in ("1", "true", "yes")
+# Backoff bounds (seconds) for reopening a failed change stream
+WATCH_RETRY_MIN = 1
+WATCH_RETRY_MAX = 60
+
+# One client (and pool) per process, sized for FastAPI's worker threads
+MONGO_CLIENT_OPTIONS = {
+    "maxPoolSize": 50,
+    "minPoolSize": 5,
+    "maxIdleTimeMS": 60000,
+    "serverSelectionTimeoutMS": 2000,
+    "connectTimeoutMS": 2000,
+    "socketTimeoutMS": 5000,
+    "retryReads": True,
+    "compressors": "zlib",
+}
 
 
 class AgentLoader:
@@ -19,20 +64,186 @@ class AgentLoader:
         # Cache agents in a temporary directory
         self._base_cache_dir = os.path.join(tempfile.gettempdir(), "agents_cache")
         os.makedirs(self._base_cache_dir, exist_ok=True)
-        print(
-            f"DEBUG: AgentLoader initialized. Cache dir: {self._base_cache_dir} | File: {__file__}"
+        # Imported agent modules, keyed by agent_id -> (version, module, loaded_at)
+        self._module_cache: dict[str, tuple[object, ModuleType, float]] = {}
+        # One load lock per agent so a cold load doesn't block other agents.
+        # Weak values: a lock only lives while some caller is using it, so
+        # unknown agent ids from clients don't accumulate
+        self._agent_locks: weakref.WeakValueDictionary[str, threading.Lock] = (
+            weakref.WeakValueDictionary()
         )
+        self._agent_locks_guard = threading.Lock()
+        self._watch_thread = None
+        self._meta_hint = None
+        self._next_index_attempt = 0.0
+        logger.debug(
+            "AgentLoader initialized. Cache dir: %s | File: %s",
+            self._base_cache_dir,
+            __file__,
+        )
+        if MONGODB_URI:
+            self._warm_up()
 
     @property
     def db(self):
         if self._db is None:
             if not MONGODB_URI:
                 raise ValueError("MONGODB_URI not set")
-            self._mongo_client = MongoClient(MONGODB_URI)
+            self._mongo_client = MongoClient(MONGODB_URI, **MONGO_CLIENT_OPTIONS)
             self._db = self._mongo_client[DB_NAME]
+            if AGENT_CACHE_WATCH:
+                self._start_invalidation_watch()
+        # Retried on later accesses if MongoDB was unreachable at startup
+        if self._meta_hint is None and time.monotonic() >= self._next_index_attempt:
+            self._ensure_indexes()
         return self._db
 
+    def _warm_up(self):
+        # Pay the connection handshake at startup rather than on the first request
+        try:
+            self.db.client.admin.command("ping")
+        except Exception as e:
+            logger.warning("MongoDB warm-up failed: %s", e)
+
+    def _ensure_indexes(self):
+        # Keeps the per-request version probe an indexed lookup
+        try:
+            self._db.agents.create_index("agent_id", unique=True)
+            self._db.agents.create_index(
+                [("agent_id", 1), ("version", 1), ("entry_script", 1)],
+                name=AGENT_META_INDEX,
+            )
+            self._db.agent_files.create_index("agent_id")
+        except Exception as e:
+            logger.warning("Could not create agents index: %s", e)
+            self._next_index_attempt = time.monotonic() + INDEX_RETRY_INTERVAL
+        else:
+            # Only hint once we know the index exists, or the probe would error
+            self._meta_hint = AGENT_META_INDEX
+
+    def _start_invalidation_watch(self):
+        self._watch_thread = threading.Thread(
+            target=self._watch_agent_updates, name="agent-cache-watch", daemon=True
+        )
+        self._watch_thread.start()
+
+    def _watch_agent_updates(self):
+        """
+        Drops cached modules as soon as their agent document changes, instead of
+        waiting for the TTL to expire. The stream is reopened with backoff
+        whenever it fails.
+        """
+        pipeline = [
+            {"$match": {"operationType": {"$in": ["update", "replace"]}}},
+            {"$project": {"fullDocument.agent_id": 1}},
+        ]
+        backoff = WATCH_RETRY_MIN
+        while True:
+            try:
+                with self._db.agents.watch(
+                    pipeline, full_document="updateLookup"
+                ) as stream:
+                    backoff = WATCH_RETRY_MIN
+                    for change in stream:
+                        agent_id = (change.get("fullDocument") or {}).get("agent_id")
+                        if agent_id and self._module_cache.pop(agent_id, None):
+                            logger.info(
+                                "Agent %s changed, dropped cached module.", agent_id
+                            )
+            except Exception as e:
+                logger.warning(
+                    "Agent change stream failed, reopening in %ss: %s", backoff, e
+                )
+            # Updates may have been missed while the stream was down
+            self._expire_cached_modules()
+            time.sleep(backoff)
+            backoff = min(backoff * 2, WATCH_RETRY_MAX)
+
+    def _expire_cached_modules(self):
+        """Makes every cached module re-check its version on next use."""
+        for agent_id, (version, module, _) in list(self._module_cache.items()):
+            self._module_cache[agent_id] = (version, module, float("-inf"))
+
     def get_agent_module(self, agent_id: str):
+        """
+        Returns the imported module for an agent.
+        Modules are cached in-process per agent version and trusted for
+        AGENT_CACHE_TTL seconds before the version is re-checked; agents
+        without a version are re-fetched and re-imported on every call.
+        If the database can't be reached, the cached module (or the copy on
+        disk) keeps being served and the probe is retried after another TTL.
+        """
+        cached = self._module_cache.get(agent_id)
+        if cached is not None and time.monotonic() - cached[2] < AGENT_CACHE_TTL:
+            return cached[1]
+
+        meta = self._get_agent_meta(agent_id)
+        if meta is None:
+            if cached is not None:
+                self._module_cache[agent_id] = (cached[0], cached[1], time.monotonic())
+                return cached[1]
+            # Load whatever version is on disk without going back to MongoDB
+            agent_dir = os.path.join(self._base_cache_dir, agent_id)
+            meta = {"version": self._read_cache_file(agent_dir, VERSION_FILE)}
+        version = meta.get("version")
+        if version is not None:
+            # Compare as strings so disk and database versions match up
+            version = str(version)
+
+        # Still current: just renew the entry, no load lock needed
+        if cached is not None and version is not None and cached[0] == version:
+            self._module_cache[agent_id] = (version, cached[1], time.monotonic())
+            return cached[1]
+
+        with self._agent_lock(agent_id):
+            # Another worker may have loaded it while we waited on the lock
+            cached = self._module_cache.get(agent_id)
+            if cached is not None and version is not None and cached[0] == version:
+                return cached[1]
+
+            module = self._load_agent_module(
+                agent_id, version, meta.get("entry_script")
+            )
+            if version is not None:
+                self._module_cache[agent_id] = (version, module, time.monotonic())
+            return module
+
+    def _agent_lock(self, agent_id: str) -> threading.Lock:
+        with self._agent_locks_guard:
+            lock = self._agent_locks.get(agent_id)
+            if lock is None:
+                lock = self._agent_locks[agent_id] = threading.Lock()
+            return lock
+
+    def _get_agent_meta(self, agent_id: str) -> dict | None:
+        """
+        Cheap probe for the agent's current version and entry script.
+        Returns an empty dict if the agent is missing, or None if the database
+        can't be reached.
+        """
+        query = {"agent_id": agent_id}
+        projection = {"version": 1, "entry_script": 1, "_id": 0}
+        try:
+            try:
+                agent_doc = self.db.agents.find_one(
+                    query, projection, hint=self._meta_hint
+                )
+            except OperationFailure as e:
+                if self._meta_hint is None:
+                    raise
+                # The hinted index is gone (e.g. the collection was dropped);
+                # probe without it and let the db property recreate the index
+                logger.warning("Dropping probe hint %s: %s", self._meta_hint, e)
+                self._meta_hint = None
+                agent_doc = self.db.agents.find_one(query, projection)
+        except Exception as e:
+            logger.error("DB Error: %s", e)
+            return None
+        return agent_doc or {}
+
+    def _load_agent_module(
+        self, agent_id: str, version=None, entry_script: str | None = None
+    ) -> ModuleType:
         """
         Fetches agent files from MongoDB, saves them to cache, and imports the module.
         Returns the module object.
@@ -40,22 +251,26 @@ class AgentLoader:
         agent_dir = os.path.join(self._base_cache_dir, agent_id)
 
         # Fetch from DB
-        self._fetch_and_save_agent(agent_id, agent_dir)
+        self._fetch_and_save_agent(agent_id, agent_dir, version)
 
         # 2. Dynamically import the module
-        agent_yaml_path = os.path.join(agent_dir, "agent.yaml")
-        if not os.path.exists(agent_yaml_path):
-            # Fallback: maybe just look for .py if no yaml
-            pass
-
-        # Let's look for the first .py file that is not standard.
-        py_files = [
-            f for f in os.listdir(agent_dir) if f.endswith(".py") and f != "__init__.py"
-        ]
-        if not py_files:
-            raise FileNotFoundError(f"No python script found for agent {agent_id}")
-
-        script_name = py_files[0]  # Take the first one for now
+        if not entry_script:
+            entry_script = self._read_cache_file(agent_dir, ENTRY_SCRIPT_FILE)
+        if entry_script:
+            script_name = entry_script
+        else:
+            # Older agent docs have no entry_script: fall back to the first
+            # .py file (sorted, so the choice is at least stable)
+            py_files = sorted(
+                f
+                for f in os.listdir(agent_dir)
+                if f.endswith(".py") and f != "__init__.py"
+            )
+            if not py_files:
+                raise FileNotFoundError(
+                    f"No python script found for agent {agent_id}"
+                )
+            script_name = py_files[0]
         script_path = os.path.join(agent_dir, script_name)
 
         # Use a unique module name to avoid conflicts
@@ -76,35 +291,166 @@ class AgentLoader:
 
         return module
 
-    def _fetch_and_save_agent(self, agent_id: str, dest_dir: str):
-        print(f"Fetching agent {agent_id} from MongoDB...")
+    def _fetch_and_save_agent(self, agent_id: str, dest_dir: str, version=None):
+        # Skip all file I/O when the cached copy is already at this version
+        cached_version = self._read_cache_file(dest_dir, VERSION_FILE)
+        if version is not None and cached_version == str(version):
+            logger.debug("Agent %s v%s already cached.", agent_id, version)
+            return
+
+        logger.info("Fetching agent %s from MongoDB...", agent_id)
         try:
-            agent_doc = self.db.agents.find_one({"agent_id": agent_id})
+            agent_doc = self.db.agents.find_one(
+                {"agent_id": agent_id},
+                {
+                    "files.name": 1,
+                    "files.content": 1,
+                    "version": 1,
+                    "entry_script": 1,
+                    "_id": 0,
+                },
+            )
         except Exception as e:
-            print(f"DB Error: {e}")
+            logger.error("DB Error: %s", e)
             agent_doc = None
 
-        if not agent_doc:
+        if agent_doc is None:
             # If not in DB, maybe we can't do anything
             # But if we are testing, let's check if the directory already exists in cache (maybe manually placed)
             if os.path.exists(dest_dir):
-                print(f"Agent {agent_id} found in cache, using cached version.")
+                logger.info("Agent %s found in cache, using cached version.", agent_id)
                 return
             raise ValueError(
                 f"Agent {agent_id} not found in database or local dev paths"
             )
 
-        if os.path.exists(dest_dir):
-            shutil.rmtree(dest_dir)
-        os.makedirs(dest_dir)
+        # Each refresh builds an immutable copy under .versions/ and publishes
+        # it by atomically repointing the dest_dir symlink, so concurrent
+        # loaders always find a complete agent directory at dest_dir
+        versions_dir = os.path.join(self._base_cache_dir, VERSIONS_DIR, agent_id)
+        os.makedirs(versions_dir, exist_ok=True)
+        version_tag = agent_doc.get("version")
+        build_dir = tempfile.mkdtemp(
+            prefix=f"v{version_tag}-" if version_tag is not None else "build-",
+            dir=versions_dir,
+        )
+        try:
+            self._write_agent_files(agent_id, agent_doc, build_dir)
+            self._compile_agent_files(build_dir, dest_dir)
+            previous = self._publish_agent_dir(build_dir, dest_dir)
+        except Exception:
+            shutil.rmtree(build_dir, ignore_errors=True)
+            raise
+        self._sweep_agent_versions(versions_dir, keep={build_dir, previous})
 
-        files = agent_doc.get("files", [])
-        for file_data in files:
-            file_path = os.path.join(dest_dir, file_data["name"])
-            with open(file_path, "w", encoding="utf-8") as f:
-                f.write(file_data["content"])
+        logger.info("Agent %s saved to %s", agent_id, dest_dir)
+
+    @staticmethod
+    def _publish_agent_dir(build_dir: str, dest_dir: str) -> str | None:
+        """
+        Points dest_dir at build_dir in one rename. Returns the build dir it
+        pointed at before, if any.
+        """
+        previous = None
+        if os.path.islink(dest_dir):
+            try:
+                previous = os.readlink(dest_dir)
+            except FileNotFoundError:
+                pass
+        elif os.path.isdir(dest_dir):
+            # Plain directory from before the .versions/ layout: move it out of
+            # the way once so the symlink can take its place
+            try:
+                os.replace(dest_dir, tempfile.mkdtemp(dir=os.path.dirname(build_dir)))
+            except FileNotFoundError:
+                pass
 
-        print(f"Agent {agent_id} saved to {dest_dir}")
+        link = f"{dest_dir}.link.{os.urandom(4).hex()}"
+        os.symlink(build_dir, link, target_is_directory=True)
+        try:
+            os.replace(link, dest_dir)
+        except OSError:
+            os.unlink(link)
+            raise
+        return previous
+
+    @staticmethod
+    def _sweep_agent_versions(versions_dir: str, keep: set):
+        """
+        Removes superseded builds. The build that was just replaced is kept
+        for loaders still reading it, and recent directories may be another
+        worker's build in progress.
+        """
+        cutoff = time.time() - VERSION_DIR_GRACE
+        for name in os.listdir(versions_dir):
+            path = os.path.join(versions_dir, name)
+            if path in keep:
+                continue
+            try:
+                if os.stat(path).st_mtime < cutoff:
+                    shutil.rmtree(path, ignore_errors=True)
+            except FileNotFoundError:
+                pass
+
+    def _write_agent_files(self, agent_id: str, agent_doc: dict, dest_dir: str):
+        files = agent_doc.get("files")
+        if files is None:
+            # Large agents keep one document per file; stream them so only a
+            # batch of file contents is held in memory at a time
+            files = self.db.agent_files.find(
+                {"agent_id": agent_id},
+                {"name": 1, "content": 1, "_id": 0},
+                batch_size=AGENT_FILES_BATCH_SIZE,
+            )
+        # Overlap the writes; batching keeps a streamed cursor from being
+        # drained into memory all at once
+        with ThreadPoolExecutor(max_workers=FILE_WRITE_WORKERS) as executor:
+            for batch in batched(files, AGENT_FILES_BATCH_SIZE):
+                list(executor.map(self._write_file, [dest_dir] * len(batch), batch))
+
+        # Saved so the agent can still be loaded from disk when the probe fails
+        for key, file_name in (
+            ("version", VERSION_FILE),
+            ("entry_script", ENTRY_SCRIPT_FILE),
+        ):
+            if agent_doc.get(key) is not None:
+                with open(os.path.join(dest_dir, file_name), "w") as f:
+                    f.write(str(agent_doc[key]))
+
+    @staticmethod
+    def _compile_agent_files(src_dir: str, dest_dir: str):
+        """
+        Writes __pycache__ bytecode for the agent's scripts so the import after
+        each refresh (and after a restart) skips parsing and compiling.
+        The .pyc files stay valid across the directory rename since they are
+        checked against the source mtime and size, not its path.
+        Best effort: a file that doesn't compile is left for the import to
+        report, since the agent may never import it.
+        """
+        for name in os.listdir(src_dir):
+            if name.endswith(".py"):
+                try:
+                    py_compile.compile(
+                        os.path.join(src_dir, name),
+                        dfile=os.path.join(dest_dir, name),
+                        doraise=True,
+                    )
+                except py_compile.PyCompileError as e:
+                    logger.warning("Could not precompile %s: %s", name, e.msg)
+
+    @staticmethod
+    def _write_file(dest_dir: str, file_data: dict):
+        file_path = os.path.join(dest_dir, file_data["name"])
+        with open(file_path, "w", encoding="utf-8") as f:
+            f.write(file_data["content"])
+
+    @staticmethod
+    def _read_cache_file(dest_dir: str, file_name: str):
+        try:
+            with open(os.path.join(dest_dir, file_name)) as f:
+                return f.read().strip()
+        except OSError:
+            return None
 
 
 # Global loader instance
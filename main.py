@@ -1,3 +1,8 @@
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from typing import Dict, List, Any
 from dotenv import load_dotenv
 from fastapi import FastAPI, HTTPException, Request
@@ -6,12 +11,26 @@ from fastapi.exceptions import RequestValidationError
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 
-# Import dynamic loader
-from agent_loader import loader
-
 # Load environment variables (fallback if not provided in request)
 load_dotenv()
 
+# Configured before importing the loader so its import-time logs are kept;
+# unknown level names fall back to INFO
+logging.basicConfig(
+    level=logging.getLevelNamesMapping().get(
+        os.getenv("LOG_LEVEL", "INFO").upper(), logging.INFO
+    )
+)
+logger = logging.getLogger(__name__)
+
+# Import dynamic loader
+from agent_loader import loader  # noqa: E402
+
+# Max agents from /execute_batch running at once, shared across batches
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+# Threads for blocking agent work (loader I/O, sync graph nodes)
+AGENT_WORKERS = int(os.getenv("AGENT_WORKERS", "32"))
+
 
 # --- 1. Data Models for API ---
 
@@ -31,7 +50,23 @@ class BatchAgentRequest(BaseModel):
 
 
 # --- 2. FastAPI App ---
-app = FastAPI(title="AI Agent Orchestrator", version="0.1.0")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # asyncio.to_thread and LangGraph's sync nodes run on the loop's default
+    # executor; size it for I/O-bound agents rather than the CPU count
+    executor = ThreadPoolExecutor(
+        max_workers=AGENT_WORKERS, thread_name_prefix="agent-worker"
+    )
+    asyncio.get_running_loop().set_default_executor(executor)
+    # Created here so it belongs to the loop that serves requests
+    app.state.batch_semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    yield
+    executor.shutdown(wait=False)
+
+
+app = FastAPI(title="AI Agent Orchestrator", version="0.1.0", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -44,26 +79,29 @@ app.add_middleware(
 
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request: Request, exc: RequestValidationError):
-    print(f"Validation Error: {exc}")
-    try:
-        body = await request.json()
-        print(f"Request Body: {body}")
-    except Exception:
-        print("Could not parse body")
+    logger.warning("Validation Error: %s", exc)
+    # Only parse the body when someone will actually see it
+    if logger.isEnabledFor(logging.DEBUG):
+        try:
+            body = await request.json()
+            logger.debug("Request Body: %s", body)
+        except Exception:
+            logger.debug("Could not parse body")
     return JSONResponse(
         status_code=422,
         content={"detail": exc.errors(), "body": str(exc)},
     )
 
 
-def _run_single_agent(request: AgentRequest) -> Dict:
+async def _run_single_agent(request: AgentRequest) -> Dict:
     """
-    Helper function to execute a single agent
+    Helper function to execute a single agent.
+    Blocking work (loading the agent, sync graphs) runs off the event loop.
     """
-    print(f"Executing agent {request.agent_id}")
+    logger.debug("Executing agent %s", request.agent_id)
 
-    # Dynamically load the agent module
-    agent_module = loader.get_agent_module(request.agent_id)
+    # Dynamically load the agent module (MongoDB + file I/O)
+    agent_module = await asyncio.to_thread(loader.get_agent_module, request.agent_id)
 
     # Check if module has required attributes
     if (
@@ -88,8 +126,12 @@ def _run_single_agent(request: AgentRequest) -> Dict:
 
     initial_state = agent_module.get_initial_state(env, inputs)
 
-    # Invoke the graph
-    final_output = agent_module.agent_graph.invoke(initial_state)
+    # Invoke the graph; LangGraph's ainvoke runs sync nodes in an executor
+    agent_graph = agent_module.agent_graph
+    if hasattr(agent_graph, "ainvoke"):
+        final_output = await agent_graph.ainvoke(initial_state)
+    else:
+        final_output = await asyncio.to_thread(agent_graph.invoke, initial_state)
 
     # Return results using specific agent's helper
     return agent_module.get_result(final_output)
@@ -101,46 +143,54 @@ def hello():
 
 
 @app.post("/execute")
-def execute_agent(request: AgentRequest):
+async def execute_agent(request: AgentRequest):
     """
     Executes the Agent with provided credentials and inputs.
     """
     try:
-        return _run_single_agent(request)
+        return await _run_single_agent(request)
     except Exception as e:
-        import traceback
-
-        traceback.print_exc()
+        logger.exception("Agent %s failed", request.agent_id)
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.post("/execute_batch")
-def execute_batch(batch_request: BatchAgentRequest):
+async def execute_batch(batch_request: BatchAgentRequest, request: Request):
     """
-    Executes multiple agents sequentially (or parallel in future).
-    Returns a list of results in common format.
+    Executes multiple agents concurrently, at most BATCH_CONCURRENCY at a time.
+    Returns a list of results in common format, in request order.
     """
+    total = len(batch_request.requests)
+    semaphore = request.app.state.batch_semaphore
+
+    async def run(i: int, req: AgentRequest):
+        async with semaphore:
+            logger.debug("Batch processing %d/%d: %s", i + 1, total, req.agent_id)
+            return await _run_single_agent(req)
+
+    outcomes = await asyncio.gather(
+        *(run(i, req) for i, req in enumerate(batch_request.requests)),
+        return_exceptions=True,
+    )
+
     results = []
     errors = []
 
-    for i, req in enumerate(batch_request.requests):
-        try:
-            print(
-                f"Batch processing {i + 1}/{len(batch_request.requests)}: {req.agent_id}"
-            )
-            result = _run_single_agent(req)
+    for req, outcome in zip(batch_request.requests, outcomes):
+        if isinstance(outcome, Exception):
+            logger.error("Agent %s failed", req.agent_id, exc_info=outcome)
             results.append(
-                {"agent_id": req.agent_id, "status": "success", "result": result}
+                {"agent_id": req.agent_id, "status": "error", "error": str(outcome)}
             )
-        except Exception as e:
-            import traceback
-
-            traceback.print_exc()
+            errors.append(str(outcome))
+        elif isinstance(outcome, BaseException):
+            raise outcome
+        else:
             results.append(
-                {"agent_id": req.agent_id, "status": "error", "error": str(e)}
+                {"agent_id": req.agent_id, "status": "success", "result": outcome}
             )
-            errors.append(str(e))
 
+    logger.info("Batch finished: %d/%d succeeded", total - len(errors), total)
     return {"results": results, "errors": errors}
 
 
@@ -1,8 +1,27 @@
-import urllib.request
+import asyncio
 import json
 import os
+import statistics
+import sys
+import time
+
+import httpx
 from dotenv import load_dotenv
 
+try:
+    import orjson
+
+    def dumps(obj, indent: bool = False) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else None)
+
+    loads = orjson.loads
+except ImportError:
+
+    def dumps(obj, indent: bool = False) -> bytes:
+        return json.dumps(obj, indent=2 if indent else None).encode("utf-8")
+
+    loads = json.loads
+
 load_dotenv()
 
 url = "http://localhost:8000/execute"
@@ -25,23 +44,57 @@ payload = {
     },
 }
 
-print(f"Sending request to {url}...")
+# Number of concurrent requests, e.g. `python test_agent.py 20` for a load test
+concurrency = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+
+print(f"Sending {concurrency} request(s) to {url}...")
 # print(json.dumps(payload, indent=2))
 
-data = json.dumps(payload).encode("utf-8")
+data = dumps(payload)
 headers = {"Content-Type": "application/json"}
-req = urllib.request.Request(url, data, headers)
 
-try:
-    with urllib.request.urlopen(req) as response:
-        print(f"Status: {response.getcode()}")
-        body = response.read().decode("utf-8")
-        try:
-            print(json.dumps(json.loads(body), indent=2))
-        except:
-            print(body)
-except urllib.error.HTTPError as e:
-    print(f"HTTP Error: {e.code} {e.reason}")
-    print(e.read().decode("utf-8"))
-except Exception as e:
+
+async def hit(client: httpx.AsyncClient):
+    start = time.perf_counter()
+    response = await client.post(url, content=data, headers=headers)
+    return response, time.perf_counter() - start
+
+
+async def run(n: int):
+    limits = httpx.Limits(max_connections=n)
+    async with httpx.AsyncClient(timeout=120, limits=limits) as client:
+        return await asyncio.gather(
+            *(hit(client) for _ in range(n)), return_exceptions=True
+        )
+
+
+def print_response(response: httpx.Response):
+    if response.is_error:
+        print(f"HTTP Error: {response.status_code} {response.reason_phrase}")
+        print(response.text)
+        return
+    print(f"Status: {response.status_code}")
+    try:
+        print(dumps(loads(response.content), indent=True).decode("utf-8"))
+    except:
+        print(response.text)
+
+
+outcomes = asyncio.run(run(concurrency))
+failures = [o for o in outcomes if isinstance(o, BaseException)]
+timings = [o for o in outcomes if not isinstance(o, BaseException)]
+
+for e in failures:
     print(f"Error: {e}")
+
+if concurrency == 1:
+    for response, _ in timings:
+        print_response(response)
+elif timings:
+    statuses = {}
+    for response, _ in timings:
+        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+    latencies = sorted(elapsed for _, elapsed in timings)
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(f"Statuses: {statuses} | errors: {len(failures)}")
+    print(f"Latency p50: {statistics.median(latencies):.3f}s | p99: {p99:.3f}s")
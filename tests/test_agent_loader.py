@@ -0,0 +1,145 @@
+import contextlib
+import os
+import tempfile
+import threading
+import types
+import unittest
+from unittest import mock
+
+from pymongo.errors import OperationFailure
+
+import agent_loader
+from agent_loader import AgentLoader
+
+
+class FakeCollection:
+    def __init__(self, docs):
+        self.docs = docs
+        self.indexes = set()
+
+    def find_one(self, query, projection=None, hint=None):
+        if hint is not None and hint not in self.indexes:
+            raise OperationFailure("hint provided does not correspond to an index")
+        return self.docs.get(query["agent_id"])
+
+    def create_index(self, keys, name=None, **kwargs):
+        self.indexes.add(name)
+
+
+class FakeDB:
+    def __init__(self, docs):
+        self.agents = FakeCollection(docs)
+        self.agent_files = FakeCollection({})
+
+
+class LoaderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        patcher = mock.patch.object(
+            agent_loader.tempfile, "gettempdir", return_value=self.tmp.name
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class MetaProbeTest(LoaderTestCase):
+    def test_probe_recovers_when_hinted_index_disappears(self):
+        db = FakeDB({"a1": {"version": 2, "entry_script": "main.py"}})
+        loader = AgentLoader()
+        loader._db = db
+        self.assertEqual(loader._get_agent_meta("a1")["version"], 2)
+        self.assertIsNotNone(loader._meta_hint)
+
+        # Collection dropped and reseeded without the index
+        db.agents.indexes.clear()
+        self.assertEqual(loader._get_agent_meta("a1")["version"], 2)
+
+
+class ChangeStreamTest(LoaderTestCase):
+    def test_watch_reopens_after_a_failure(self):
+        delivered = threading.Event()
+        attempts = []
+
+        @contextlib.contextmanager
+        def watch(pipeline, full_document=None):
+            attempts.append(pipeline)
+            if len(attempts) == 1:
+                raise OperationFailure("stream lost")
+
+            def events():
+                yield {"fullDocument": {"agent_id": "a1"}}
+                delivered.set()
+                threading.Event().wait()  # stay open like a real stream
+
+            yield events()
+
+        loader = AgentLoader()
+        loader._db = FakeDB({})
+        loader._db.agents.watch = watch
+        module = types.ModuleType("a1")
+        loader._module_cache["a1"] = ("1", module, float("inf"))
+        loader._module_cache["a2"] = ("1", module, float("inf"))
+
+        with mock.patch.object(agent_loader, "WATCH_RETRY_MIN", 0):
+            loader._start_invalidation_watch()
+            self.assertTrue(delivered.wait(5))
+
+        self.assertEqual(len(attempts), 2)
+        self.assertNotIn("a1", loader._module_cache)
+        # Entries that may have missed an update during the outage re-check
+        self.assertEqual(loader._module_cache["a2"][2], float("-inf"))
+
+
+class AgentLockTest(LoaderTestCase):
+    def test_unknown_agent_ids_do_not_leave_locks_behind(self):
+        loader = AgentLoader()
+        loader._db = FakeDB({})
+        for i in range(50):
+            with self.assertRaises(ValueError):
+                loader.get_agent_module(f"missing-{i}")
+        self.assertEqual(len(loader._agent_locks), 0)
+
+
+class ConcurrentRefreshTest(LoaderTestCase):
+
+    def test_imports_never_see_a_missing_agent_dir(self):
+        # Unversioned agents are re-fetched on every load, so each load both
+        # refreshes the agent dir and imports from it
+        docs = {
+            "a1": {
+                "entry_script": "main.py",
+                "files": [
+                    {"name": "main.py", "content": "X = 1\n"},
+                    {"name": "helpers.py", "content": "Y = 2\n"},
+                ],
+            }
+        }
+        errors = []
+
+        def worker():
+            # One loader per simulated uvicorn worker, sharing the cache dir
+            loader = AgentLoader()
+            loader._db = FakeDB(docs)
+            for _ in range(150):
+                try:
+                    self.assertEqual(loader.get_agent_module("a1").X, 1)
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        cache_dir = os.path.join(self.tmp.name, "agents_cache")
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(cache_dir, "a1"))),
+            ["__pycache__", "entry_script.txt", "helpers.py", "main.py"],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()